@@ -1,12 +1,24 @@
 import os
+import sys
 import subprocess
 import numpy as np
-import random
-import pickle
 import cv2
 import math
-import xml.etree.cElementTree as ET
+from xml.sax.saxutils import escape
 import json
+import multiprocessing
+import hashlib
+import struct
+import collections
+import concurrent.futures
+import io
+import mmap
+import tarfile
+import time
+import zipfile
+import shutil
+import tempfile
+import threading
 
 
 def assert_path(path, error_message):
@@ -19,6 +31,14 @@ def count_files(path, filename_starts_with=''):
     return len(files)
 
 
+def remove_files(path, filename_starts_with):
+    if not os.path.exists(path):
+        return
+    for f in os.listdir(path):
+        if f.startswith(filename_starts_with) and os.path.isfile(os.path.join(path, f)):
+            os.remove(os.path.join(path, f))
+
+
 def touch(fname, times=None):
     with open(fname, 'a'):
         os.utime(fname, times)
@@ -26,252 +46,1088 @@ def touch(fname, times=None):
 
 def init_directories():
     # Setup the directory structure.
-    if not os.path.exists(destination_path):
-        os.makedirs(os.path.join(destination_path, 'images'))
-        os.makedirs(os.path.join(destination_path, 'ImageSets', 'Main'))
-        os.makedirs(os.path.join(destination_path, 'Annotations'))
-        os.makedirs(os.path.join(destination_path, 'Annotations_json'))
-        os.makedirs(os.path.join(destination_path, 'pickle_store'))
-        os.makedirs(os.path.join(destination_path, 'labels'))
-
-    # Flush the train-val-test split. A new split will be created each time this script is run.
-    for f in os.listdir(os.path.join(destination_path, 'ImageSets', 'Main')):
-        os.remove(os.path.join(destination_path, 'ImageSets', 'Main', f))
-
-    # Creating empty files.
-    touch(os.path.join(destination_path, 'ImageSets', 'Main', 'train.txt'))
-    touch(os.path.join(destination_path, 'ImageSets', 'Main', 'val.txt'))
-    touch(os.path.join(destination_path, 'ImageSets', 'Main', 'test.txt'))
-    touch(os.path.join(destination_path, 'ImageSets', 'Main', 'trainval.txt'))
-
-
-def split_video(video_file, image_name_prefix):
-    return subprocess.check_output('ffmpeg -i ' + os.path.abspath(video_file) + ' '+ image_name_prefix +'%d.jpg', shell=True, cwd=os.path.join(destination_path, 'images'))
+    for folder in ('images', os.path.join('ImageSets', 'Main'), 'Annotations', 'Annotations_json', 'pickle_store',
+                   'labels', 'manifest', 'reports'):
+        if not os.path.exists(os.path.join(destination_path, folder)):
+            os.makedirs(os.path.join(destination_path, folder))
 
+    # The train-val-test split is created anew each time this script is run and replaces
+    # the list files of the previous run once it is complete, see write_split_lists.
 
-def log(message, level='info'):
-    formatters = {
-        'GREEN': '\033[92m',
-        'END': '\033[0m',
-    }
-    print(message)
-
-
-def write_to_file(filename, content):
-    f = open(filename, 'a')
-    f.write(content+'\n')
 
+def video_prefix(scene, video_index):
+    # Prefix of the names of everything written for a video: images, annotations, manifest, caches.
+    return scene + '_video' + str(video_index) + '_'
 
-def split_dataset(number_of_frames, split_ratio, file_name_prefix):
-    assert sum(split_ratio) <= 1, 'Split ratio cannot be more than 1.'
 
-    train, val, test = np.array(split_ratio) * number_of_frames
+def video_file_path(scene, video_index):
+    return os.path.join(dataset_path, 'videos', scene, 'video' + str(video_index), 'video.mov')
 
-    test_images = random.sample(range(1, number_of_frames+1), int(test))
-    val_images = random.sample(tuple(set(range(1, number_of_frames+1)) - set(test_images)), int(val))
-    train_images = random.sample(tuple(set(range(1, number_of_frames+1)) - set(test_images) - set(val_images)), int(train))
 
-    for index in train_images:
-        write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'train.txt'), file_name_prefix+str(index))
-        write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'trainval.txt'), file_name_prefix+str(index))
+def annotation_file(scene, video_index):
+    return os.path.join(dataset_path, 'annotations', scene, 'video' + str(video_index), 'annotations.txt')
 
-    for index in val_images:
-        write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'val.txt'), file_name_prefix+str(index))
-        write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'trainval.txt'), file_name_prefix+str(index))
 
-    for index in test_images:
-        write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'test.txt'), file_name_prefix+str(index))
+def split_video(video_file, image_name_prefix, frame_stride=1, backend='ffmpeg', image_format='jpg', quality=None,
+                scale=1.0, threads=None):
+    # Writes frames 1, 1 + frame_stride, 1 + 2 * frame_stride... of the video to
+    # images/<image_name_prefix><frame number>.<image_format>. quality and scale are only
+    # supported by the cv2 backend. threads is the number of encoder threads of the cv2
+    # backend (4 by default) or ffmpeg's -threads (its own choice by default). Returns the number of bytes written. ffmpeg
+    # prints its own progress, except in pool workers, see run_ffmpeg.
+    if backend == 'cv2':
+        return extract_frames(video_file, image_name_prefix, frame_stride, image_format, quality, scale,
+                              4 if threads is None else threads)
+    assert backend == 'ffmpeg', 'Unknown extraction backend ' + backend
+    assert quality is None and scale == 1.0, 'quality and scale need the cv2 backend.'
 
+    image_ext = '.' + image_format
+    jpeg_image_path = os.path.join(destination_path, 'images')
+    thread_option = '' if threads is None else '-threads ' + str(int(threads)) + ' '
+    if frame_stride == 1:
+        run_ffmpeg(thread_option + '-i ' + os.path.abspath(video_file) + ' '+ image_name_prefix +'%d' + image_ext, jpeg_image_path)
+    else:
+        # Only decode and write every frame_stride-th frame. ffmpeg numbers the selected frames
+        # 1, 2, 3..., rename them to the frame number they have in the full video.
+        run_ffmpeg(thread_option + '-i ' + os.path.abspath(video_file) +
+                   ' -vf "select=not(mod(n\\,' + str(frame_stride) + '))" -vsync vfr ' +
+                   image_name_prefix + '%d' + image_ext, jpeg_image_path)
+        number_of_images = count_images(jpeg_image_path, image_name_prefix, image_ext=image_ext)
+        # Highest number first, the new name of an image is never the name of an image not yet renamed.
+        for index in range(number_of_images, 1, -1):
+            os.rename(os.path.join(jpeg_image_path, image_name_prefix + str(index) + image_ext),
+                      os.path.join(jpeg_image_path, image_name_prefix + str(1 + (index - 1) * frame_stride) + image_ext))
+
+    # ffmpeg does not say how much it wrote, stat the images it wrote by name.
+    number_of_images = count_images(jpeg_image_path, image_name_prefix, frame_stride, image_ext)
+    return sum(os.path.getsize(os.path.join(jpeg_image_path, image_name_prefix + str(frame_number) + image_ext))
+               for frame_number in extracted_frame_numbers(number_of_images, frame_stride))
+
+
+def run_ffmpeg(arguments, cwd):
+    # In pool workers ffmpeg prints neither its banner nor its progress, which would mix with
+    # the output of the other workers. What it still reports, warnings and errors, goes
+    # through log.
+    if log_queue is None:
+        return subprocess.check_output('ffmpeg ' + arguments, shell=True, cwd=cwd)
+    try:
+        output = subprocess.check_output('ffmpeg -loglevel error -nostats ' + arguments, shell=True, cwd=cwd,
+                                         stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as error:
+        log('ffmpeg ' + arguments + ' failed: ' + error.output.decode('utf-8', 'replace').strip(), 'error')
+        raise
+    if len(output.strip()) > 0:
+        log('ffmpeg ' + arguments + ': ' + output.decode('utf-8', 'replace').strip(), 'warning')
+    return output
+
+
+def extract_frames(video_file, image_name_prefix, frame_stride=1, image_format='jpg', quality=None, scale=1.0,
+                   threads=4):
+    # In-process alternative to ffmpeg. Frames are decoded with cv2.VideoCapture on this thread
+    # and encoded and written by a pool of threads, cv2 releases the GIL while encoding.
+    # Skipped frames are only grabbed, not decoded into an image. Returns the number of bytes written.
+    encode_params = []
+    if quality is not None:
+        quality_flags = {'jpg': cv2.IMWRITE_JPEG_QUALITY, 'webp': cv2.IMWRITE_WEBP_QUALITY}
+        assert image_format in quality_flags, 'quality is not supported for ' + image_format
+        encode_params = [quality_flags[image_format], int(quality)]
+    image_ext = '.' + image_format
+    jpeg_image_path = os.path.join(destination_path, 'images')
+
+    def encode_and_write(frame_number, frame):
+        if scale != 1.0:
+            frame = cv2.resize(frame, (int(round(frame.shape[1] * scale)), int(round(frame.shape[0] * scale))),
+                               interpolation=cv2.INTER_AREA)
+        success, content = cv2.imencode(image_ext, frame, encode_params)
+        assert success, 'Cannot encode frame ' + str(frame_number) + ' of ' + video_file
+        return write_bytes(os.path.join(jpeg_image_path, image_name_prefix + str(frame_number) + image_ext),
+                           content.tobytes())
+
+    capture = cv2.VideoCapture(video_file)
+    assert capture.isOpened(), 'Cannot open ' + video_file
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    progress = Progress((frame_count + frame_stride - 1) // frame_stride if frame_count > 0 else None,
+                        PROGRESS_INTERVAL)
+    executor = concurrent.futures.ThreadPoolExecutor(threads)
+    pending = collections.deque()
+    bytes_written = 0
+    try:
+        frame_number = 0
+        while True:
+            frame_number += 1
+            if (frame_number - 1) % frame_stride != 0:
+                if not capture.grab():
+                    break
+                continue
+            success, frame = capture.read()
+            if not success:
+                break
+            # Bound the number of decoded frames waiting for an encoder.
+            if len(pending) >= 4 * threads:
+                bytes_written += pending.popleft().result()
+            pending.append(executor.submit(encode_and_write, frame_number, frame))
+            progress.update('Extracting ' + image_name_prefix)
+        while len(pending) > 0:
+            bytes_written += pending.popleft().result()
+    finally:
+        executor.shutdown()
+        capture.release()
+    return bytes_written
+
+
+def count_images(path, image_name_prefix, frame_stride=1, image_ext='.jpg'):
+    # Number of images split_video wrote for a video. They are numbered 1, 1 + frame_stride,
+    # 1 + 2 * frame_stride... without gaps, so a binary search over their existence finds the
+    # last one with a few stat calls instead of listing the whole images folder.
+    def exists(index):
+        return os.path.exists(os.path.join(path, image_name_prefix + str(1 + (index - 1) * frame_stride) + image_ext))
+
+    if not exists(1):
+        return 0
+    low, high = 1, 2
+    while exists(high):
+        low, high = high, high * 2
+    # exists(low) and not exists(high)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if exists(middle):
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def jpeg_size(path):
+    # (height, width, depth) from the frame header of a JPEG file, without decoding the pixels.
+    with open(path, 'rb') as fid:
+        assert fid.read(2) == b'\xff\xd8', path + ' is not a JPEG file.'
+        while True:
+            marker = fid.read(2)
+            # Markers may be preceded by any number of 0xff fill bytes.
+            while marker[1:] == b'\xff':
+                marker = marker[1:] + fid.read(1)
+            assert len(marker) == 2 and marker[0:1] == b'\xff', 'Cannot find the frame header of ' + path
+            code = ord(marker[1:])
+            if 0xd0 <= code <= 0xd9 or code == 0x01:
+                # Markers without a payload
+                continue
+            length = struct.unpack('>H', fid.read(2))[0]
+            if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+                precision, height, width, depth = struct.unpack('>BHHB', fid.read(6))
+                return height, width, depth
+            fid.seek(length - 2, 1)
+
+
+def image_size(path):
+    # (height, width, depth) of an image, read from the header for JPEG files.
+    if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg'):
+        return jpeg_size(path)
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    return image.shape if image.ndim == 3 else image.shape + (1,)
+
+
+def probe_video(video_file):
+    # Size, frame rate and frame count from the container metadata, without decoding the video.
+    capture = cv2.VideoCapture(video_file)
+    assert capture.isOpened(), 'Cannot open ' + video_file
+    metadata = {'width': int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                'height': int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                'fps': capture.get(cv2.CAP_PROP_FPS),
+                'frame_count': int(capture.get(cv2.CAP_PROP_FRAME_COUNT))}
+    capture.release()
+    return metadata
+
+
+def load_video_metadata(video_file, image_name_prefix):
+    # probe_video, cached in pickle_store and keyed on the size and mtime of the video.
+    stat = os.stat(video_file)
+    key = '{}-{}'.format(stat.st_size, int(stat.st_mtime * 1e6))
+    cache_dir = os.path.join(destination_path, 'pickle_store')
+    cache_file = os.path.join(cache_dir, image_name_prefix + 'metadata.json')
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as fid:
+            metadata = json.load(fid)
+        if metadata.get('key') == key:
+            return metadata
+
+    metadata = probe_video(video_file)
+    metadata['key'] = key
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(cache_file + '.tmp', 'w') as fid:
+        json.dump(metadata, fid)
+    os.rename(cache_file + '.tmp', cache_file)
+    return metadata
+
+
+LOG_COLORS = {'success': '\033[92m', 'warning': '\033[93m', 'error': '\033[91m'}
+
+# Set in pool workers, whose messages are printed by the main process, see relay_logs.
+log_queue = None
 
-def annotate_frames(sdd_annotation_file, dest_path, filename_prefix, number_of_frames):
 
-    # Pickle the actual SDD annotation
-    pickle_file = os.path.join(destination_path, 'pickle_store', filename_prefix + 'annotation.pkl')
-    if os.path.exists(pickle_file):
-        with open(pickle_file, 'rb') as fid:
-            sdd_annotation = pickle.load(fid)
-    else:
-        sdd_annotation = np.genfromtxt(sdd_annotation_file, delimiter=' ', dtype=np.str)
-        with open(pickle_file, 'wb') as fid:
-            pickle.dump(sdd_annotation, fid)
+def log(message, level='info'):
+    # Messages are colored by level when printed to a terminal. Each is written as one
+    # whole line and flushed right away, so that lines of different threads do not mix.
+    if log_queue is not None:
+        log_queue.put((message, level))
+        return
+    color = LOG_COLORS.get(level)
+    if color is not None and sys.stdout.isatty():
+        message = color + message + '\033[0m'
+    sys.stdout.write(message + '\n')
+    sys.stdout.flush()
+
+
+def relay_logs(queue):
+    # Print the messages of the pool workers, in the order they arrive, until None.
+    for message, level in iter(queue.get, None):
+        log(message, level)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def cpu_time():
+    # User and system time of this process, its threads and its finished children (ffmpeg).
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def process_peak_rss():
+    # Peak resident set size in bytes of this process or of its largest finished child,
+    # whichever is larger. On Linux the peak of this process also starts over at each
+    # reset_peak_rss. ru_maxrss is in kilobytes on Linux and in bytes on macOS. None where
+    # the resource module is missing (Windows).
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def reset_peak_rss():
+    # Resets the peak RSS of this process to its current RSS (Linux only). Returns whether it
+    # could, so that stage_peak_rss is only trusted after a successful reset.
+    try:
+        with open('/proc/self/clear_refs', 'w') as fout:
+            fout.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def stage_peak_rss():
+    # Peak resident set size in bytes of this process since the last reset_peak_rss, from VmHWM.
+    # None without /proc. ffmpeg runs in a child process and is not included.
+    try:
+        with open('/proc/self/status') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class StageTimer(object):
+    # Measures one stage of one video (or of the whole dataset) and appends its record to
+    # records when the block exits. The wall time, CPU time and peak RSS are measured, the
+    # frames, rows and bytes_written are filled in by the caller. peak_rss is the peak of the
+    # stage alone where the peak can be reset (Linux) and None elsewhere; process_peak_rss also
+    # counts the largest finished child (ffmpeg) of the process, and elsewhere is the high
+    # water mark of the process up to the end of the stage.
+    def __init__(self, records, name, stage):
+        self.records = records
+        self.name = name
+        self.stage = stage
+        self.frames = None
+        self.rows = None
+        self.bytes_written = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start_wall_time = time.perf_counter()
+        self.start_cpu_time = cpu_time()
+        self.peak_rss_reset = reset_peak_rss()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = {'name': self.name,
+                  'stage': self.stage,
+                  'started': self.started,
+                  'wall_time': time.perf_counter() - self.start_wall_time,
+                  'cpu_time': cpu_time() - self.start_cpu_time,
+                  'frames': self.frames,
+                  'rows': self.rows,
+                  'bytes_written': self.bytes_written,
+                  'peak_rss': stage_peak_rss() if self.peak_rss_reset else None,
+                  'process_peak_rss': process_peak_rss(),
+                  'pid': os.getpid(),
+                  'failed': exc_type is not None}
+        self.records.append(record)
+        if exc_type is None:
+            log('{} {}: {:.1f}s wall, {:.1f}s cpu{}{}'.format(
+                self.name, self.stage, record['wall_time'], record['cpu_time'],
+                '' if self.frames is None else ', {:.1f} frames/s'.format(self.frames / max(record['wall_time'], 1e-9)),
+                '' if self.bytes_written is None else ', {:.1f} MB written'.format(self.bytes_written / 1e6)))
+        return False
+
+
+# Seconds between the progress messages of the frame loops
+PROGRESS_INTERVAL = 10.
+
+
+class Progress(object):
+    # Logs finished items with the elapsed time and an ETA extrapolated from the average time
+    # per item so far. With an interval, logs at most once every interval seconds and when the
+    # last item is done. total can be None when it is not known, there is no ETA then.
+    def __init__(self, total, interval=None):
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.start = time.perf_counter()
+        self.last_log = self.start
+
+    def update(self, message):
+        self.count += 1
+        now = time.perf_counter()
+        if self.interval is not None and now - self.last_log < self.interval and self.count != self.total:
+            return
+        self.last_log = now
+        elapsed = now - self.start
+        if self.total is None:
+            log('[{}] {} ({} elapsed)'.format(self.count, message, format_duration(elapsed)))
+            return
+        eta = elapsed / self.count * max(self.total - self.count, 0)
+        log('[{}/{}] {} ({} elapsed, ETA {})'.format(self.count, self.total, message, format_duration(elapsed),
+                                                     format_duration(eta)))
+
+
+def summarize_stages(records):
+    # Totals of the stage records per stage.
+    totals = dict()
+    for record in records:
+        total = totals.setdefault(record['stage'], {'count': 0, 'wall_time': 0., 'cpu_time': 0., 'frames': 0,
+                                                    'rows': 0, 'bytes_written': 0, 'peak_rss': None,
+                                                    'process_peak_rss': None})
+        total['count'] += 1
+        for key in ('wall_time', 'cpu_time', 'frames', 'rows', 'bytes_written'):
+            total[key] += record[key] or 0
+        for key in ('peak_rss', 'process_peak_rss'):
+            if record[key] is not None:
+                total[key] = max(total[key] or 0, record[key])
+    return totals
+
+
+def write_run_report(report):
+    # reports/run-<start time>.json, one per run of split_and_annotate.
+    filename = os.path.join(destination_path, 'reports',
+                            time.strftime('run-%Y%m%d-%H%M%S.json', time.localtime(report['started'])))
+    with open(filename + '.tmp', 'w') as fout:
+        json.dump(report, fout, indent=4)
+    os.rename(filename + '.tmp', filename)
+    return filename
+
+
+SPLIT_LISTS = ('train', 'val', 'test', 'trainval')
+
+
+def new_split_lists():
+    # Image names of each list file, collected in memory and written once by write_split_lists.
+    return dict((name, []) for name in SPLIT_LISTS)
+
+
+def write_split_lists(split_lists):
+    # Write each list file in one go, through a temporary file so that a crashed run never
+    # leaves a half written list behind. Returns the number of bytes written.
+    bytes_written = 0
+    for name in SPLIT_LISTS:
+        filename = os.path.join(destination_path, 'ImageSets', 'Main', name + '.txt')
+        bytes_written += write_bytes(filename + '.tmp',
+                                     ''.join(image_name + '\n' for image_name in split_lists[name]).encode('utf-8'))
+        os.rename(filename + '.tmp', filename)
+    return bytes_written
+
+
+def split_dataset(number_of_frames, split_ratio, file_name_prefix, split_lists, random_state=np.random):
+    assert sum(split_ratio) <= 1, 'Split ratio cannot be more than 1.'
 
-    # Create VOC style annotation.
-    first_image_path = os.path.join(destination_path, 'images', filename_prefix+'1.jpg')
-    assert_path(first_image_path, 'Cannot find the images. Trying to access: ' + first_image_path)
-    first_image = cv2.imread(first_image_path)
-    height, width, depth = first_image.shape
-
-    for frame_number in range(1, number_of_frames+1):
-        annotation = ET.Element("annotation")
-        ET.SubElement(annotation, "folder").text = destination_folder_name
-        source = ET.SubElement(annotation, "source")
-        ET.SubElement(source, "database").text = 'Stanford Drone Dataset'
-        size = ET.SubElement(annotation, "size")
-        ET.SubElement(size, "width").text = str(width)
-        ET.SubElement(size, "height").text = str(height)
-        ET.SubElement(size, "depth").text = str(depth)
-        ET.SubElement(annotation, "segmented").text = '0'
-        ET.SubElement(annotation, "filename").text = filename_prefix + str(frame_number)
-
-        annotations_in_frame = sdd_annotation[sdd_annotation[:, 5] == str(frame_number)]
+    train, val, test = (np.array(split_ratio) * number_of_frames).astype(int)
+
+    # One random permutation of the frames, cut into test, val and train.
+    frames = random_state.permutation(number_of_frames) + 1
+    test_images = frames[:test]
+    val_images = frames[test:test + val]
+    train_images = frames[test + val:test + val + train]
+
+    train_names = [file_name_prefix + str(index) for index in train_images]
+    val_names = [file_name_prefix + str(index) for index in val_images]
+    split_lists['train'].extend(train_names)
+    split_lists['trainval'].extend(train_names)
+    split_lists['val'].extend(val_names)
+    split_lists['trainval'].extend(val_names)
+    split_lists['test'].extend(file_name_prefix + str(index) for index in test_images)
+
+
+# SDD labels, in the order of their category ids in the COCO and YOLO output.
+SDD_LABELS = ('Pedestrian', 'Biker', 'Cart', 'Skater', 'Bus', 'Car')
+CATEGORY_IDS = dict((label, category_id) for category_id, label in enumerate(SDD_LABELS))
+
+# One row of annotations.txt:
+# track_id xmin ymin xmax ymax frame lost occluded generated "label"
+SDD_ANNOTATION_DTYPE = np.dtype([('track_id', np.int32),
+                                 ('xmin', np.int32),
+                                 ('ymin', np.int32),
+                                 ('xmax', np.int32),
+                                 ('ymax', np.int32),
+                                 ('frame', np.int32),
+                                 ('lost', np.uint8),
+                                 ('occluded', np.uint8),
+                                 ('generated', np.uint8),
+                                 ('label', np.uint8)])
+
+
+def parse_sdd_annotation(sdd_annotation_file):
+    # Swap the quoted labels for their category ids so the whole file can go
+    # through numpy's C tokenizer in one call.
+    with open(sdd_annotation_file, 'r') as fid:
+        text = fid.read()
+    for label, category_id in CATEGORY_IDS.items():
+        text = text.replace('"' + label + '"', str(category_id))
+    assert '"' not in text, 'Unknown label in ' + sdd_annotation_file
+
+    values = np.fromstring(text, dtype=np.int64, sep=' ')
+    number_of_columns = len(SDD_ANNOTATION_DTYPE.names)
+    assert len(values) % number_of_columns == 0, 'Malformed annotation file ' + sdd_annotation_file
+    values = values.reshape(-1, number_of_columns)
+
+    sdd_annotation = np.empty(len(values), dtype=SDD_ANNOTATION_DTYPE)
+    for column, name in enumerate(SDD_ANNOTATION_DTYPE.names):
+        sdd_annotation[name] = values[:, column]
+
+    # Store the rows grouped by frame, the order every writer walks them in.
+    return sdd_annotation[np.argsort(sdd_annotation['frame'], kind='stable')]
+
+
+def load_annotation(sdd_annotation_file, filename_prefix):
+    # Cache the typed SDD annotation as a .npy keyed on the size and mtime of the
+    # source file, warm runs memory-map it instead of parsing the text again.
+    stat = os.stat(sdd_annotation_file)
+    cache_name = '{}annotation-{}-{}.npy'.format(filename_prefix, stat.st_size, int(stat.st_mtime * 1e6))
+    cache_dir = os.path.join(destination_path, 'pickle_store')
+    cache_file = os.path.join(cache_dir, cache_name)
+    if os.path.exists(cache_file):
+        return np.load(cache_file, mmap_mode='r')
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    sdd_annotation = parse_sdd_annotation(sdd_annotation_file)
+
+    # Drop caches of older versions of the annotation file.
+    for f in os.listdir(cache_dir):
+        if f.startswith(filename_prefix + 'annotation'):
+            os.remove(os.path.join(cache_dir, f))
+    with open(cache_file + '.tmp', 'wb') as fid:
+        np.save(fid, sdd_annotation)
+    os.rename(cache_file + '.tmp', cache_file)
+    return np.load(cache_file, mmap_mode='r')
+
+
+def build_frame_index(sdd_annotation):
+    # Group the annotation rows by frame once, CSR style: rows of frame f live in
+    # sorted_annotation[offsets[f]:offsets[f + 1]].
+    frames = sdd_annotation['frame']
+    if len(frames) > 1 and not np.all(frames[1:] >= frames[:-1]):
+        sdd_annotation = sdd_annotation[np.argsort(frames, kind='stable')]
+        frames = sdd_annotation['frame']
+    max_frame = int(frames.max()) if len(frames) > 0 else -1
+    offsets = np.zeros(max_frame + 2, dtype=np.int64)
+    np.cumsum(np.bincount(frames, minlength=max_frame + 1), out=offsets[1:])
+    return sdd_annotation, offsets
+
+
+def scale_annotation(sdd_annotation, scale):
+    # Boxes of frames that were resized by scale when they were extracted.
+    if scale == 1.0:
+        return sdd_annotation
+    sdd_annotation = np.array(sdd_annotation)
+    for name in ('xmin', 'ymin', 'xmax', 'ymax'):
+        sdd_annotation[name] = np.round(sdd_annotation[name] * scale)
+    return sdd_annotation
+
+
+def frame_annotations(frame_index, frame_number):
+    sorted_annotation, offsets = frame_index
+    if frame_number < 0 or frame_number + 1 >= len(offsets):
+        return sorted_annotation[:0]
+    return sorted_annotation[offsets[frame_number]:offsets[frame_number + 1]]
+
+
+# Frame rate of the SDD videos, used when the video itself is not available.
+SDD_FPS = 30.
+
+
+def group_rows(offsets, groups):
+    # Row numbers of the given CSR groups, group after group, without a Python loop.
+    groups = np.asarray(groups, dtype=np.int64)
+    starts = offsets[groups]
+    counts = offsets[groups + 1] - starts
+    return np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+
+class TrackStore(object):
+    # The annotation of a video grouped by track, CSR style like build_frame_index: rows of
+    # the i-th track, track_ids[i], live in annotation[offsets[i]:offsets[i + 1]] ordered by
+    # frame. fps is the frame rate the frame numbers count in.
+
+    def __init__(self, sdd_annotation, fps=SDD_FPS):
+        sdd_annotation = np.asarray(sdd_annotation)
+        self.annotation = sdd_annotation[np.lexsort((sdd_annotation['frame'], sdd_annotation['track_id']))]
+        self.track_ids, counts = np.unique(self.annotation['track_id'], return_counts=True)
+        self.offsets = np.zeros(len(self.track_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.fps = fps
+        # Per track: the frames it spans and its label (SDD tracks keep one label)
+        self.first_frames = self.annotation['frame'][self.offsets[:-1]]
+        self.last_frames = self.annotation['frame'][self.offsets[1:] - 1]
+        self.labels = self.annotation['label'][self.offsets[:-1]]
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def _track_numbers(self, track_ids):
+        track_numbers = np.searchsorted(self.track_ids, track_ids)
+        found = track_numbers < len(self.track_ids)
+        found[found] = self.track_ids[track_numbers[found]] == np.asarray(track_ids)[found]
+        if not np.all(found):
+            raise KeyError('Unknown track ' + str(np.asarray(track_ids)[~found][0]))
+        return track_numbers
+
+    def track(self, track_id):
+        # Rows of one track, ordered by frame.
+        track_number = self._track_numbers([track_id])[0]
+        return self.annotation[self.offsets[track_number]:self.offsets[track_number + 1]]
+
+    def select(self, track_ids=None, start_frame=None, end_frame=None, labels=None):
+        # Numbers of the tracks with the given ids and labels (names or category ids) that
+        # have a row in frames start_frame..end_frame.
+        selected = np.ones(len(self.track_ids), dtype=bool)
+        if track_ids is not None:
+            selected[:] = False
+            selected[self._track_numbers(np.atleast_1d(track_ids))] = True
+        if labels is not None:
+            if isinstance(labels, (str, int, np.integer)):
+                labels = [labels]
+            category_ids = []
+            for label in labels:
+                if isinstance(label, str):
+                    if label not in CATEGORY_IDS:
+                        raise KeyError('Unknown label ' + label)
+                    label = CATEGORY_IDS[label]
+                category_ids.append(int(label))
+            selected &= np.isin(self.labels, category_ids)
+        if start_frame is not None:
+            selected &= self.last_frames >= start_frame
+        if end_frame is not None:
+            selected &= self.first_frames <= end_frame
+        return np.flatnonzero(selected)
+
+    def query(self, track_ids=None, start_frame=None, end_frame=None, labels=None):
+        # Rows of the selected tracks within frames start_frame..end_frame (inclusive), track
+        # after track. Only the rows of the selected tracks are looked at.
+        rows = self.annotation[group_rows(self.offsets, self.select(track_ids, start_frame, end_frame, labels))]
+        if start_frame is not None:
+            rows = rows[rows['frame'] >= start_frame]
+        if end_frame is not None:
+            rows = rows[rows['frame'] <= end_frame]
+        return rows
+
+    def filter(self, drop_lost=False, drop_occluded=False, drop_generated=False, fps=None):
+        # A new TrackStore without the flagged rows. With fps, only the frames that are a
+        # multiple of round(self.fps / fps) are kept, the same frames for every track.
+        keep = np.ones(len(self.annotation), dtype=bool)
+        for drop, flag in ((drop_lost, 'lost'), (drop_occluded, 'occluded'), (drop_generated, 'generated')):
+            if drop:
+                keep &= self.annotation[flag] == 0
+        if fps is not None:
+            assert 0 < fps <= self.fps, 'Cannot subsample {} fps tracks to {} fps'.format(self.fps, fps)
+            keep &= self.annotation['frame'] % int(round(self.fps / fps)) == 0
+        return TrackStore(self.annotation[keep], self.fps)
+
+    def trajectories(self, track_numbers=None):
+        # Box centres of the selected tracks (all by default), CSR style: points of the i-th
+        # track, track_ids[i], are points[offsets[i]:offsets[i + 1]] as (frame, x, y) rows.
+        if track_numbers is None:
+            track_numbers = np.arange(len(self.track_ids))
+        track_numbers = np.asarray(track_numbers, dtype=np.int64)
+        rows = self.annotation[group_rows(self.offsets, track_numbers)]
+        counts = self.offsets[track_numbers + 1] - self.offsets[track_numbers]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        points = np.empty((len(rows), 3), dtype=np.float32)
+        points[:, 0] = rows['frame']
+        points[:, 1] = (rows['xmin'] + rows['xmax']) / 2.
+        points[:, 2] = (rows['ymin'] + rows['ymax']) / 2.
+        return self.track_ids[track_numbers], offsets, points
+
+    def padded_trajectories(self, track_numbers=None, length=None):
+        # The trajectories as one (tracks, length, 3) array padded with NaN, and the number of
+        # points of each track. Tracks longer than length are cut.
+        track_ids, offsets, points = self.trajectories(track_numbers)
+        counts = np.diff(offsets)
+        if length is None:
+            length = int(counts.max()) if len(counts) > 0 else 0
+        padded = np.full((len(track_ids), length, 3), np.nan, dtype=np.float32)
+        track = np.repeat(np.arange(len(track_ids)), counts)
+        position = np.arange(len(points)) - np.repeat(offsets[:-1], counts)
+        inside = position < length
+        padded[track[inside], position[inside]] = points[inside]
+        return track_ids, padded, np.minimum(counts, length)
+
+    def save_trajectories(self, filename, track_numbers=None):
+        # The trajectories and labels of the selected tracks in a .npz file.
+        track_ids, offsets, points = self.trajectories(track_numbers)
+        if track_numbers is None:
+            track_numbers = np.arange(len(self.track_ids))
+        np.savez(filename, track_ids=track_ids, labels=self.labels[track_numbers], offsets=offsets, points=points,
+                 fps=self.fps)
+
+
+def load_track_store(scene, video_index):
+    # TrackStore of a video from the cached annotation, with the frame rate of the video.
+    image_name_prefix = video_prefix(scene, video_index)
+    sdd_annotation_file = annotation_file(scene, video_index)
+    video_file = video_file_path(scene, video_index)
+    fps = SDD_FPS
+    if os.path.exists(video_file):
+        fps = load_video_metadata(video_file, image_name_prefix)['fps'] or SDD_FPS
+    return TrackStore(load_annotation(sdd_annotation_file, image_name_prefix), fps)
+
+
+# Pascal VOC annotation, in the layout ElementTree writes it.
+VOC_HEADER = ('<annotation><folder>{folder}</folder><source><database>Stanford Drone Dataset</database></source>'
+              '<size><width>{width}</width><height>{height}</height><depth>{depth}</depth></size>'
+              '<segmented>0</segmented><filename>')
+VOC_OBJECT = ('<object><name>%s</name><pose>Unspecified</pose><truncated>%d</truncated><difficult>0</difficult>'
+              '<bndbox><xmin>%d</xmin><ymin>%d</ymin><xmax>%d</xmax><ymax>%d</ymax></bndbox></object>')
+
+
+class VocSink(object):
+    # Writes one Pascal VOC xml file per frame, rendered from VOC_HEADER/VOC_OBJECT. The files
+    # are written by a pool of threads, or packed into a single tar/zip archive per video.
+
+    def __init__(self, dest_path, filename_prefix, width, height, depth, writer_threads=4, archive=None):
+        assert archive in (None, 'tar', 'zip'), 'Unknown archive format ' + str(archive)
+        self.dest_path = dest_path
+        self.filename_prefix = filename_prefix
+        self.header = VOC_HEADER.format(folder=escape(destination_folder_name), width=width, height=height,
+                                        depth=depth) + escape(filename_prefix)
+        self.names = [escape(label) for label in SDD_LABELS]
+
+        self.archive = None
+        self.archive_filename = None
+        self.executor = None
+        self.pending = collections.deque()
+        self.bytes_written = 0
+        self.max_pending = 64 * writer_threads
+        if archive == 'tar':
+            self.archive_filename = os.path.join(dest_path, filename_prefix + 'xml.tar')
+            self.archive = tarfile.open(self.archive_filename, 'w')
+        elif archive == 'zip':
+            self.archive_filename = os.path.join(dest_path, filename_prefix + 'xml.zip')
+            self.archive = zipfile.ZipFile(self.archive_filename, 'w', zipfile.ZIP_DEFLATED)
+        elif writer_threads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(writer_threads)
+
+    def start(self, frame_index):
+        pass
+
+    def write_frame(self, frame_number, annotations_in_frame):
+        objects = ''.join(VOC_OBJECT % (self.names[label], occluded, xmin, ymin, xmax, ymax)
+                          for label, occluded, xmin, ymin, xmax, ymax in
+                          zip(annotations_in_frame['label'].tolist(), annotations_in_frame['occluded'].tolist(),
+                              annotations_in_frame['xmin'].tolist(), annotations_in_frame['ymin'].tolist(),
+                              annotations_in_frame['xmax'].tolist(), annotations_in_frame['ymax'].tolist()))
+        content = (self.header + str(frame_number) + '</filename>' + objects + '</annotation>').encode('us-ascii')
+        filename = self.filename_prefix + str(frame_number) + ".xml"
+
+        if isinstance(self.archive, tarfile.TarFile):
+            info = tarfile.TarInfo(filename)
+            info.size = len(content)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(content))
+        elif isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(filename, content)
+        elif self.executor is not None:
+            # Bound the number of files waiting to be written.
+            if len(self.pending) >= self.max_pending:
+                self.bytes_written += self.pending.popleft().result()
+            self.pending.append(self.executor.submit(write_bytes, os.path.join(self.dest_path, filename), content))
+        else:
+            self.bytes_written += write_bytes(os.path.join(self.dest_path, filename), content)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.bytes_written = os.path.getsize(self.archive_filename)
+        if self.executor is not None:
+            while len(self.pending) > 0:
+                self.bytes_written += self.pending.popleft().result()
+            self.executor.shutdown()
+
+
+def write_bytes(filename, content):
+    # Returns the number of bytes written.
+    with open(filename, 'wb') as fout:
+        fout.write(content)
+    return len(content)
+
+
+class CocoWriter(object):
+    # Streams a COCO style json file to disk. Images are written as they come, annotations
+    # are spooled to a temporary file and appended on close, so memory use stays flat.
+    # indent=None writes compact json.
+
+    def __init__(self, filename, indent=None):
+        self.filename = filename
+        self.indent = indent
+        self.number_of_images = 0
+        self.number_of_annotations = 0
+        self.bytes_written = 0
+
+        self.jfile = open(filename + '.tmp', 'w')
+        self.spool = tempfile.TemporaryFile('w+')
+        self.jfile.write('{' + self._dumps('info') + ': ' + self._dumps([{'description': 'Standford UAV Dataset'}]) +
+                         ', ' + self._dumps('images') + ': [')
+
+    def _dumps(self, obj):
+        if self.indent is None:
+            return json.dumps(obj, separators=(',', ':'))
+        return json.dumps(obj, indent=self.indent)
+
+    def add_image(self, img):
+        self.jfile.write((',' if self.number_of_images > 0 else '') + self._dumps(img))
+        self.number_of_images += 1
+
+    def add_annotation(self, annots):
+        self.spool.write((',' if self.number_of_annotations > 0 else '') + self._dumps(annots))
+        self.number_of_annotations += 1
+
+    def close(self):
+        self.jfile.write('], ' + self._dumps('annotations') + ': [')
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.jfile)
+        self.spool.close()
+        categories = [{'id': category_id, 'name': label} for category_id, label in enumerate(SDD_LABELS)]
+        self.jfile.write('], ' + self._dumps('categories') + ': ' + self._dumps(categories) + '}')
+        self.jfile.close()
+        self.bytes_written = os.path.getsize(self.filename + '.tmp')
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def coco_image(image_id, file_name, width, height, depth):
+    img = dict()
+    # Image info
+    img['id'] = image_id
+    img['width'] = width
+    img['height'] = height
+    img['depth'] = depth
+    img['file_name'] = file_name
+    return img
+
+
+def coco_annotation(annotation_id, image_id, annotation_data):
+    annots = dict()
+
+    annots['id'] = annotation_id  # ID of unique object
+    annots['image_id'] = image_id
+    annots['category_id'] = int(annotation_data['label'])  # Category class
+
+    box_width = abs(float(annotation_data['xmax']) - float(annotation_data['xmin']))
+    box_height = abs(float(annotation_data['ymax']) - float(annotation_data['ymin']))
+    annots['bbox'] = [float(annotation_data['xmin']), float(annotation_data['ymin']), box_width, box_height]
+    #annots['iscrowd'] = annotation_data[7]
+    annots['iscrowd'] = 0
+    annots['bbox_mode'] = 1
+    annots['area'] = box_width * box_height
+    return annots
+
+
+class CocoSink(object):
+    # Streams the frames of a video into one COCO style json file. The first 10 frames
+    # also go into a tiny test file.
+
+    def __init__(self, dest_path, filename_prefix, width, height, depth, indent=None, image_ext='.jpg'):
+        self.filename_prefix = filename_prefix
+        self.image_ext = image_ext
+        self.width = width
+        self.height = height
+        self.depth = depth
+
+        self.writer = CocoWriter(os.path.join(dest_path, filename_prefix + '.json'), indent)
+        self.tiny_writer = CocoWriter(os.path.join(dest_path, filename_prefix + 'tiny' + '.json'), indent)
+        self.bytes_written = 0
+
+    def start(self, frame_index):
+        pass
+
+    def write_frame(self, frame_number, annotations_in_frame):
+        img = coco_image(frame_number, self.filename_prefix + str(frame_number) + self.image_ext,
+                         self.width, self.height, self.depth)
+        self.writer.add_image(img)
+        if self.tiny_writer is not None:
+            self.tiny_writer.add_image(img)
 
         for annotation_data in annotations_in_frame:
-            object = ET.SubElement(annotation, "object")
-            ET.SubElement(object, "name").text = annotation_data[9].replace('"','')
-            ET.SubElement(object, "pose").text = 'Unspecified'
-            ET.SubElement(object, "truncated").text = annotation_data[7] # occluded
-            ET.SubElement(object, "difficult").text = '0'
-            bndbox = ET.SubElement(object, "bndbox")
-            ET.SubElement(bndbox, "xmin").text = annotation_data[1]
-            ET.SubElement(bndbox, "ymin").text = annotation_data[2]
-            ET.SubElement(bndbox, "xmax").text = annotation_data[3]
-            ET.SubElement(bndbox, "ymax").text = annotation_data[4]
-
-        xml_annotation = ET.ElementTree(annotation)
-        xml_annotation.write(os.path.join(dest_path, filename_prefix + str(frame_number) + ".xml"))
-
-
-def annotate_frames_json(sdd_annotation_file, dest_path, filename_prefix, number_of_frames):
-
-    jpeg_ids = {'Pedestrian': 0,
-                'Biker': 1,
-                'Cart': 2,
-                'Skater': 3,
-                'Bus': 4,
-                'Car': 5}
-
-    # Pickle the actual SDD annotation
-    pickle_file = os.path.join(destination_path, 'pickle_store', filename_prefix + 'annotation.pkl')
-    if os.path.exists(pickle_file):
-        with open(pickle_file, 'rb') as fid:
-            sdd_annotation = pickle.load(fid)
-    else:
-        sdd_annotation = np.genfromtxt(sdd_annotation_file, delimiter=' ', dtype=np.str)
-        with open(pickle_file, 'wb') as fid:
-            pickle.dump(sdd_annotation, fid)
-
-    # Create COCO style annotation.
-    first_image_path = os.path.join(destination_path, 'images', filename_prefix+'1.jpg')
-    assert_path(first_image_path, 'Cannot find the images. Trying to access: ' + first_image_path)
-    first_image = cv2.imread(first_image_path)
-    height, width, depth = first_image.shape
-
-    coco = dict()
-    coco['info'] = []
-    coco['info'].append({'description': 'Standford UAV Dataset'})
-    coco['images'] = []
-    coco['annotations'] = []
-
-    coco['categories'] = [{'id': 0, 'name': 'Pedestrian'},
-                          {'id': 1, 'name': 'Biker'},
-                          {'id': 2, 'name': 'Cart'},
-                          {'id': 3, 'name': 'Skater'},
-                          {'id': 4, 'name': 'Bus'},
-                          {'id': 5, 'name': 'Car'}]
-
-    prev_max_id = 0  # To ensure unique annotation IDs
-
-    for frame_number in range(1, number_of_frames + 1):
-        img = dict()
-        # Image info
-        img['id'] = frame_number
-        img['width'] = width
-        img['height'] = height
-        img['depth'] = depth
-        img['file_name'] = filename_prefix + str(frame_number) + '.jpg'
-
-        coco['images'].append(img)
-
-        annotations_in_frame = sdd_annotation[sdd_annotation[:, 5] == str(frame_number)]
-
-        for count, annotation_data in enumerate(annotations_in_frame, prev_max_id):
-            annots = dict()
-            category = annotation_data[9].replace('"', '')
-
-            annots['id'] = int(frame_number) + count  # ID of unique object
-            annots['image_id'] = frame_number
-            annots['category_id'] = int(jpeg_ids[category])  # Category class
-
-            box_width = abs(float(annotation_data[3]) - float(annotation_data[1]))
-            box_height = abs(float(annotation_data[4]) - float(annotation_data[2]))
-            annots['bbox'] = [float(annotation_data[1]), float(annotation_data[2]), box_width, box_height]
-            #annots['iscrowd'] = annotation_data[7]
-            annots['iscrowd'] = 0
-            annots['bbox_mode'] = 1
-            annots['area'] = box_width * box_height
-
-            coco['annotations'].append(annots)
-
-            prev_max_id = count
+            # Annotation IDs are unique within the video.
+            annots = coco_annotation(self.writer.number_of_annotations + 1, frame_number, annotation_data)
+            self.writer.add_annotation(annots)
+            if self.tiny_writer is not None:
+                self.tiny_writer.add_annotation(annots)
 
         # Create tiny test dataset
-        if frame_number == 10:
-            with open(os.path.join(dest_path, filename_prefix + 'tiny' + '.json'), 'w') as jfile:
-                json.dump(coco, jfile, indent=4)
-                jfile.close()
-    with open(os.path.join(dest_path, filename_prefix + '.json'), 'w') as jfile:
-        json.dump(coco, jfile, indent=4)
-        jfile.close()
-
-
-def annotate_frames_txt(sdd_annotation_file, dest_path, filename_prefix, number_of_frames):
-
-    jpeg_ids = {'Pedestrian': 0,
-                'Biker': 1,
-                'Cart': 2,
-                'Skater': 3,
-                'Bus': 4,
-                'Car': 5}
-
-    # Pickle the actual SDD annotation
-    pickle_file = os.path.join(destination_path, 'pickle_store', filename_prefix + 'annotation.pkl')
-    if os.path.exists(pickle_file):
-        with open(pickle_file, 'rb') as fid:
-            sdd_annotation = pickle.load(fid)
-    else:
-        sdd_annotation = np.genfromtxt(sdd_annotation_file, delimiter=' ', dtype=np.str)
-        with open(pickle_file, 'wb') as fid:
-            pickle.dump(sdd_annotation, fid)
-
-    # Create COCO style annotation.
-    first_image_path = os.path.join(destination_path, 'images', filename_prefix+'1.jpg')
-    assert_path(first_image_path, 'Cannot find the images. Trying to access: ' + first_image_path)
-    first_image = cv2.imread(first_image_path)
-    height, width, depth = first_image.shape
-
-    for frame_number in range(1, number_of_frames + 1):
-        annotations_in_frame = sdd_annotation[sdd_annotation[:, 5] == str(frame_number)]
-        filename = filename_prefix + str(frame_number) + '.txt'
-
-        with open(os.path.join(dest_path, filename), 'w') as fout:
-            for annotation_data in annotations_in_frame:
-                category = annotation_data[9].replace('"', '')
-
-                if int(annotation_data[1]) < 0:
-                    annotation_data[1] = '0'
-                if int(annotation_data[3]) > width:
-                    annotation_data[3] = str(width)
-                if int(annotation_data[2]) < 0:
-                    annotation_data[2] = '0'
-                if int(annotation_data[4]) > height:
-                    annotation_data[4] = str(height)
-
-                box_width = abs(int(annotation_data[3]) - int(annotation_data[1]))
-                box_height = abs(int(annotation_data[4]) - int(annotation_data[2]))
-
-                x_center = int(annotation_data[1]) + (box_width / 2)
-                y_center = int(annotation_data[2]) + (box_height / 2)
-
-                box_width = box_width / width  # Normalize
-                box_height = box_height / height  # Normalize
-
-                x_center = x_center / width  # Normalize
-                y_center = y_center / height  # Normalize
+        if self.tiny_writer is not None and self.tiny_writer.number_of_images == 10:
+            self.tiny_writer.close()
+            self.bytes_written += self.tiny_writer.bytes_written
+            self.tiny_writer = None
+
+    def close(self):
+        self.writer.close()
+        self.bytes_written += self.writer.bytes_written
+        if self.tiny_writer is not None:
+            self.tiny_writer.close()
+            self.bytes_written += self.tiny_writer.bytes_written
+
+
+class YoloSink(object):
+    # Writes one YOLO label file per frame, boxes normalized to the image size.
+    # The boxes of the whole video are clipped and normalized at once in start.
+
+    def __init__(self, dest_path, filename_prefix, width, height, depth):
+        self.dest_path = dest_path
+        self.filename_prefix = filename_prefix
+        self.width = width
+        self.height = height
+        self.bytes_written = 0
+
+    def start(self, frame_index):
+        sdd_annotation, offsets = frame_index
+
+        # Clip to the image, boxes left with no area lie outside the frame and are dropped.
+        xmin = np.clip(sdd_annotation['xmin'], 0, self.width)
+        ymin = np.clip(sdd_annotation['ymin'], 0, self.height)
+        xmax = np.clip(sdd_annotation['xmax'], 0, self.width)
+        ymax = np.clip(sdd_annotation['ymax'], 0, self.height)
+        keep = (xmax > xmin) & (ymax > ymin)
+
+        box_width = (xmax - xmin)[keep]
+        box_height = (ymax - ymin)[keep]
+        self.labels = sdd_annotation['label'][keep]
+        self.x_center = (xmin[keep] + box_width / 2.) / self.width  # Normalize
+        self.y_center = (ymin[keep] + box_height / 2.) / self.height  # Normalize
+        self.box_width = box_width / float(self.width)  # Normalize
+        self.box_height = box_height / float(self.height)  # Normalize
+
+        # Offsets of each frame among the kept boxes
+        self.offsets = np.concatenate(([0], np.cumsum(keep)))[offsets]
+
+    def frame_lines(self, frame_number):
+        if not 0 <= frame_number < len(self.offsets) - 1:
+            return ''
+        rows = slice(self.offsets[frame_number], self.offsets[frame_number + 1])
+        return ''.join('%d %.6f %.6f %.6f %.6f\n' % row
+                       for row in zip(self.labels[rows].tolist(), self.x_center[rows].tolist(),
+                                      self.y_center[rows].tolist(), self.box_width[rows].tolist(),
+                                      self.box_height[rows].tolist()))
+
+    def write_frame(self, frame_number, annotations_in_frame):
+        filename = self.filename_prefix + str(frame_number) + '.txt'
+        self.bytes_written += write_bytes(os.path.join(self.dest_path, filename),
+                                          self.frame_lines(frame_number).encode('us-ascii'))
+
+    def close(self):
+        pass
+
+
+# Annotation formats the engine can emit: format -> (sink, default output folder inside destination_path)
+ANNOTATION_SINKS = {'xml': (VocSink, 'Annotations'),
+                    'json': (CocoSink, 'Annotations_json'),
+                    'txt': (YoloSink, 'labels')}
+DEFAULT_ANNOTATION_FORMATS = ('xml', 'json', 'txt')
+
+
+def annotate_video(sdd_annotation_file, filename_prefix, number_of_frames, formats=DEFAULT_ANNOTATION_FORMATS,
+                   dest_paths=None, frame_index=None, frame_numbers=None, sink_options=None, size=None,
+                   scale=1.0):
+    # Load the annotation once and walk the frames once, feeding every requested format.
+    # frame_numbers restricts the output to a subset of frames 1..number_of_frames.
+    # sink_options maps a format to extra keyword arguments for its sink.
+    # size is the (height, width, depth) of the images, read from the first image if not given.
+    # scale is the factor the frames were resized by when they were extracted.
+    for annotation_format in formats:
+        assert annotation_format in ANNOTATION_SINKS, 'Unknown annotation format ' + annotation_format
+    if dest_paths is None:
+        dest_paths = dict()
+    if sink_options is None:
+        sink_options = dict()
+
+    if frame_index is None:
+        frame_index = build_frame_index(scale_annotation(load_annotation(sdd_annotation_file, filename_prefix),
+                                                         scale))
+
+    if size is None:
+        first_image_path = os.path.join(destination_path, 'images', filename_prefix+'1.jpg')
+        assert_path(first_image_path, 'Cannot find the images. Trying to access: ' + first_image_path)
+        size = image_size(first_image_path)
+    height, width, depth = size
+
+    sinks = []
+    for annotation_format in formats:
+        sink_class, folder = ANNOTATION_SINKS[annotation_format]
+        dest_path = dest_paths.get(annotation_format, os.path.join(destination_path, folder))
+        sinks.append(sink_class(dest_path, filename_prefix, width, height, depth,
+                                **sink_options.get(annotation_format, dict())))
+
+    for sink in sinks:
+        sink.start(frame_index)
+
+    if frame_numbers is None:
+        frame_numbers = range(1, number_of_frames + 1)
+    progress = Progress(len(frame_numbers), PROGRESS_INTERVAL)
+    number_of_rows = 0
+    for frame_number in frame_numbers:
+        annotations_in_frame = frame_annotations(frame_index, frame_number)
+        number_of_rows += len(annotations_in_frame)
+        for sink in sinks:
+            sink.write_frame(frame_number, annotations_in_frame)
+        progress.update('Annotating ' + filename_prefix)
+
+    for sink in sinks:
+        sink.close()
+    # Number of annotation rows written to each format, and bytes written over all formats
+    return number_of_rows, sum(sink.bytes_written for sink in sinks)
+
+
+def annotate_frames(sdd_annotation_file, dest_path, filename_prefix, number_of_frames, frame_index=None):
+    # Create VOC style annotation.
+    annotate_video(sdd_annotation_file, filename_prefix, number_of_frames, ('xml',), {'xml': dest_path}, frame_index)
 
-                fout.write('{} {} {} {} {}\n'.format(jpeg_ids[category], x_center, y_center, box_width, box_height))
-            fout.close()
 
-    return
+def annotate_frames_json(sdd_annotation_file, dest_path, filename_prefix, number_of_frames, frame_index=None):
+    # Create COCO style annotation.
+    annotate_video(sdd_annotation_file, filename_prefix, number_of_frames, ('json',), {'json': dest_path},
+                   frame_index)
+
+
+def annotate_frames_txt(sdd_annotation_file, dest_path, filename_prefix, number_of_frames, frame_index=None):
+    # Create YOLO style annotation.
+    annotate_video(sdd_annotation_file, filename_prefix, number_of_frames, ('txt',), {'txt': dest_path},
+                   frame_index)
+
+
+def tile_grid(width, height, tile_size, overlap):
+    # (x0, y0, x1, y1) of tiles of tile_size x tile_size covering the image, neighbours overlapping
+    # by at least overlap pixels. The last row and column are aligned with the image border.
+    assert 0 <= overlap < tile_size, 'overlap must be at least 0 and less than tile_size.'
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, tile_size - overlap))
+        return positions + [length - tile_size]
+
+    return np.array([(x, y, min(x + tile_size, width), min(y + tile_size, height))
+                     for y in starts(height) for x in starts(width)], dtype=np.int64).reshape(-1, 4)
+
+
+def object_crops(boxes, width, height, tile_size):
+    # Crops of tile_size x tile_size centred on the objects, kept inside the image. An object that
+    # already lies inside an earlier crop does not get a crop of its own.
+    x0 = np.clip((boxes[:, 0] + boxes[:, 2]) // 2 - tile_size // 2, 0, max(width - tile_size, 0))
+    y0 = np.clip((boxes[:, 1] + boxes[:, 3]) // 2 - tile_size // 2, 0, max(height - tile_size, 0))
+    crops = np.stack([x0, y0, np.minimum(x0 + tile_size, width), np.minimum(y0 + tile_size, height)],
+                     axis=1).astype(np.int64).reshape(-1, 4)
+
+    # contains[i, j]: box j lies inside the crop of box i, for all pairs at once.
+    contains = ((crops[:, None, 0] <= boxes[None, :, 0]) & (crops[:, None, 1] <= boxes[None, :, 1]) &
+                (boxes[None, :, 2] <= crops[:, None, 2]) & (boxes[None, :, 3] <= crops[:, None, 3]))
+    covered = np.zeros(len(crops), dtype=bool)
+    keep = []
+    for crop in range(len(crops)):
+        if not covered[crop]:
+            keep.append(crop)
+            covered |= contains[crop]
+    return crops[keep]
+
+
+def tile_video(image_name_prefix, frame_index, frame_numbers, size, image_ext='.jpg', tile_size=640, overlap=128,
+               mode='grid', min_visibility=0.5, empty_tile_drop_rate=1.0, seed=0):
+    # Cut the frames into tiles (mode='grid') or object centred crops (mode='objects') and write
+    # them with YOLO labels to tiles/images and tiles/labels. A box goes into a tile when at
+    # least min_visibility of its area is inside it, clipped to the tile. Tiles without boxes
+    # are dropped with probability empty_tile_drop_rate. Each frame is decoded at most once.
+    # Returns the number of tiles and the number of bytes written.
+    assert mode in ('grid', 'objects'), 'Unknown tiling mode ' + mode
+    height, width, depth = size
+    images_path = os.path.join(destination_path, 'tiles', 'images')
+    labels_path = os.path.join(destination_path, 'tiles', 'labels')
+    for path in (images_path, labels_path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+    random_state = np.random.RandomState(seed)
+    grid = tile_grid(width, height, tile_size, overlap)
+    progress = Progress(len(frame_numbers), PROGRESS_INTERVAL)
+    number_of_tiles = 0
+    bytes_written = 0
+
+    for frame_number in frame_numbers:
+        annotations_in_frame = frame_annotations(frame_index, frame_number)
+        boxes = np.stack([np.clip(annotations_in_frame['xmin'], 0, width),
+                          np.clip(annotations_in_frame['ymin'], 0, height),
+                          np.clip(annotations_in_frame['xmax'], 0, width),
+                          np.clip(annotations_in_frame['ymax'], 0, height)], axis=1).astype(np.int64)
+        tiles = grid if mode == 'grid' else object_crops(boxes, width, height, tile_size)
+
+        # Boxes clipped to every tile at once, shape (tiles, boxes).
+        x0 = np.maximum(tiles[:, None, 0], boxes[None, :, 0])
+        y0 = np.maximum(tiles[:, None, 1], boxes[None, :, 1])
+        x1 = np.minimum(tiles[:, None, 2], boxes[None, :, 2])
+        y1 = np.minimum(tiles[:, None, 3], boxes[None, :, 3])
+        visible_area = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+        box_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        in_tile = (visible_area > 0) & (visible_area >= min_visibility * box_area[None, :])
+
+        keep_tile = in_tile.any(axis=1) | (random_state.random_sample(len(tiles)) >= empty_tile_drop_rate)
+        if not keep_tile.any():
+            progress.update('Tiling ' + image_name_prefix)
+            continue
+
+        image = cv2.imread(os.path.join(destination_path, 'images', image_name_prefix + str(frame_number) + image_ext))
+        for tile in np.flatnonzero(keep_tile):
+            tx0, ty0, tx1, ty1 = tiles[tile].tolist()
+            tile_width = float(tx1 - tx0)
+            tile_height = float(ty1 - ty0)
+            rows = in_tile[tile]
+            lines = ''.join('%d %.6f %.6f %.6f %.6f\n' % row for row in zip(
+                annotations_in_frame['label'][rows].tolist(),
+                (((x0[tile, rows] + x1[tile, rows]) / 2. - tx0) / tile_width).tolist(),
+                (((y0[tile, rows] + y1[tile, rows]) / 2. - ty0) / tile_height).tolist(),
+                ((x1[tile, rows] - x0[tile, rows]) / tile_width).tolist(),
+                ((y1[tile, rows] - y0[tile, rows]) / tile_height).tolist()))
+
+            tile_name = image_name_prefix + str(frame_number) + '_' + str(tx0) + '_' + str(ty0)
+            success, content = cv2.imencode(image_ext, image[ty0:ty1, tx0:tx1])
+            assert success, 'Cannot encode tile ' + tile_name
+            bytes_written += write_bytes(os.path.join(images_path, tile_name + image_ext), content.tobytes())
+            bytes_written += write_bytes(os.path.join(labels_path, tile_name + '.txt'), lines.encode('us-ascii'))
+            number_of_tiles += 1
+        progress.update('Tiling ' + image_name_prefix)
+    return number_of_tiles, bytes_written
 
 
 def calculate_share(num_training_images, num_val_images, num_testing_images):
@@ -297,35 +1153,38 @@ def calculate_share(num_training_images, num_val_images, num_testing_images):
     return (num_training_images/train_videos, num_val_images/val_videos, num_testing_images/test_videos)
 
 
-def split_dataset_uniformly(number_of_frames, split_ratio, share, file_name_prefix):
+def uniform_frame_stride(number_of_frames, split_ratio, share):
+    # Every how many frames a video contributes one image to its train/val/test share.
     index_of_one = split_ratio.index(1)
     share_of_this_video = share[index_of_one]
-    skip_by = int(math.ceil(float(number_of_frames)/share_of_this_video))
-    image_index = [i for i in range(1, number_of_frames+1, skip_by)]
-
-    for index in image_index:
-        if index_of_one == 0:
-            # Training
-            write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'train.txt'),
-                          file_name_prefix + str(index))
-            write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'trainval.txt'),
-                          file_name_prefix + str(index))
-        elif index_of_one == 1:
-            # Validation
-            write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'val.txt'), file_name_prefix + str(index))
-            write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'trainval.txt'),
-                          file_name_prefix + str(index))
-        elif index_of_one == 2:
-            # Testing
-            write_to_file(os.path.join(destination_path, 'ImageSets', 'Main', 'test.txt'), file_name_prefix + str(index))
+    return max(1, int(math.ceil(float(number_of_frames)/share_of_this_video)))
 
 
-def split_and_annotate(num_training_images=None, num_val_images=None, num_testing_images=None,
-                       json_annot=False, txt_annot=False):
-    assert_path(dataset_path, ''.join(e for e in dataset_path if e.isalnum()) + ' folder should be found in the cwd of this script.')
-    init_directories()
-    if num_training_images is not None and num_val_images is not None and num_testing_images is not None:
-        share = calculate_share(num_training_images, num_val_images, num_testing_images)
+def split_dataset_uniformly(number_of_frames, split_ratio, share, file_name_prefix, split_lists, frame_numbers=None):
+    # frame_numbers are the frames to put in the split when the video was only extracted at
+    # the uniform stride, number_of_frames is not used then.
+    index_of_one = split_ratio.index(1)
+    if frame_numbers is None:
+        skip_by = uniform_frame_stride(number_of_frames, split_ratio, share)
+        frame_numbers = np.arange(1, number_of_frames+1, skip_by)
+    image_names = [file_name_prefix + str(index) for index in frame_numbers]
+
+    if index_of_one == 0:
+        # Training
+        split_lists['train'].extend(image_names)
+        split_lists['trainval'].extend(image_names)
+    elif index_of_one == 1:
+        # Validation
+        split_lists['val'].extend(image_names)
+        split_lists['trainval'].extend(image_names)
+    elif index_of_one == 2:
+        # Testing
+        split_lists['test'].extend(image_names)
+
+
+def list_videos():
+    # (scene, video_index) of every video in videos_to_be_processed, in processing order.
+    videos_list = []
     for scene in videos_to_be_processed:
         path = os.path.join(dataset_path, 'videos', scene)
         assert_path(path, path + ' not found.')
@@ -336,47 +1195,443 @@ def split_and_annotate(num_training_images=None, num_val_images=None, num_testin
                 video_path = os.path.join(path, 'video' + str(video_index))
                 assert_path(video_path, video_path + ' not found.')
                 assert count_files(video_path) == 1, video_path+' should contain one file.'
+                videos_list.append((scene, video_index))
+    return videos_list
+
+
+def file_fingerprint(path, sample_size=None):
+    # sha1 of the content of a file. With sample_size only the size and the first and last
+    # sample_size bytes are hashed, which is enough to tell videos apart without reading gigabytes.
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fid:
+        if sample_size is None:
+            for chunk in iter(lambda: fid.read(1 << 20), b''):
+                sha1.update(chunk)
+        else:
+            size = os.fstat(fid.fileno()).st_size
+            sha1.update(str(size).encode())
+            sha1.update(fid.read(sample_size))
+            fid.seek(max(size - sample_size, 0))
+            sha1.update(fid.read(sample_size))
+    return sha1.hexdigest()
+
+
+def load_manifest(name):
+    # The manifest of a video records for each stage (extract, each annotation format, split)
+    # the inputs it was run with and whether it completed.
+    manifest_file = os.path.join(destination_path, 'manifest', name + '.json')
+    if not os.path.exists(manifest_file):
+        return dict()
+    with open(manifest_file, 'r') as fid:
+        return json.load(fid)
+
+
+def save_manifest(name, manifest):
+    manifest_file = os.path.join(destination_path, 'manifest', name + '.json')
+    with open(manifest_file + '.tmp', 'w') as fid:
+        json.dump(manifest, fid, indent=4, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+
+def stage_complete(manifest, stage, inputs):
+    record = manifest.get(stage)
+    return record is not None and record['complete'] and record['inputs'] == json.loads(json.dumps(inputs))
+
+
+def record_stage(name, manifest, stage, inputs, complete, outputs=None):
+    manifest[stage] = {'inputs': json.loads(json.dumps(inputs)), 'complete': complete, 'outputs': outputs}
+    save_manifest(name, manifest)
+
+
+def extracted_frame_numbers(number_of_images, frame_stride=1):
+    # Frame numbers of the images split_video wrote for a video.
+    return range(1, (number_of_images - 1) * frame_stride + 2, frame_stride)
+
+
+def prepare_video(scene, video_index, annotation_formats=DEFAULT_ANNOTATION_FORMATS, frame_stride=1,
+                  sink_options=None, extraction_options=None, tiling_options=None):
+    # Split one video into frames and annotate them. With frame_stride > 1 only frames
+    # 1, 1 + frame_stride, 1 + 2 * frame_stride... are extracted and annotated.
+    # extraction_options are extra keyword arguments for split_video, tiling_options for
+    # tile_video; the frames are only tiled when tiling_options is given.
+    # Stages whose inputs did not change since they last completed are skipped.
+    # Returns the StageTimer records of the stages that ran.
+    if sink_options is None:
+        sink_options = dict()
+    if extraction_options is None:
+        extraction_options = dict()
+    assert 'frame_stride' not in extraction_options, \
+        'frame_stride is not an extraction option, it is set by extract_selected_only.'
+    jpeg_image_path = os.path.join(destination_path, 'images')
+    image_name_prefix = video_prefix(scene, video_index)
+    video_file = video_file_path(scene, video_index)
+    sdd_annotation_file = annotation_file(scene, video_index)
+    assert_path(sdd_annotation_file, 'Annotation file not found. '
+                                     'Trying to access ' + sdd_annotation_file)
+    manifest = load_manifest(image_name_prefix)
+    records = []
+
+    # Split video into frames
+    # Check whether the video has already been made into frames
+    # The number of encoder threads does not change the frames, it is left out.
+    extract_inputs = {'video': file_fingerprint(video_file, 1 << 20), 'frame_stride': frame_stride,
+                      'options': dict((key, value) for key, value in extraction_options.items() if key != 'threads')}
+    if not stage_complete(manifest, 'extract', extract_inputs):
+        # Drop the frames of an interrupted or outdated split first
+        remove_files(jpeg_image_path, image_name_prefix)
+        record_stage(image_name_prefix, manifest, 'extract', extract_inputs, False)
+        log('Splitting ' + video_file)
+        with StageTimer(records, image_name_prefix, 'extract') as timer:
+            timer.bytes_written = split_video(video_file, image_name_prefix, frame_stride, **extraction_options)
+            image_ext = '.' + extraction_options.get('image_format', 'jpg')
+            timer.frames = count_images(jpeg_image_path, image_name_prefix, frame_stride, image_ext)
+        log('Splitting ' + video_file + ' complete.', 'success')
+        # Record what was extracted, later stages read it from the manifest instead of the images folder
+        first_image_path = os.path.join(jpeg_image_path, image_name_prefix + '1' + image_ext)
+        assert_path(first_image_path, 'Cannot find the images. Trying to access: ' + first_image_path)
+        record_stage(image_name_prefix, manifest, 'extract', extract_inputs, True,
+                     {'images': timer.frames,
+                      'size': image_size(first_image_path),
+                      'image_ext': image_ext,
+                      'scale': extraction_options.get('scale', 1.0)})
+    else:
+        log(video_file + ' is already split into frames. Skipping...')
+    extract_outputs = manifest['extract']['outputs']
+    # COCO file names carry the image extension
+    sink_options = dict(sink_options)
+    sink_options['json'] = dict(sink_options.get('json', dict()), image_ext=extract_outputs['image_ext'])
+
+    # Annotate
+    annotation_fingerprint = file_fingerprint(sdd_annotation_file)
+    annotation_inputs = dict()
+    for annotation_format in annotation_formats:
+        annotation_inputs[annotation_format] = {'annotation': annotation_fingerprint, 'extract': extract_inputs,
+                                                'options': sink_options.get(annotation_format, dict())}
+    stale_formats = tuple(annotation_format for annotation_format in annotation_formats
+                          if not stage_complete(manifest, annotation_format, annotation_inputs[annotation_format]))
+    if len(stale_formats) > 0:
+        log('Annotating frames from ' + video_file + ' (' + ', '.join(stale_formats) + ')')
+        for annotation_format in stale_formats:
+            remove_files(os.path.join(destination_path, ANNOTATION_SINKS[annotation_format][1]), image_name_prefix)
+            record_stage(image_name_prefix, manifest, annotation_format, annotation_inputs[annotation_format], False)
+        frame_numbers = extracted_frame_numbers(extract_outputs['images'], frame_stride)
+        # Create the requested annotations in a single pass over the frames, timed as one stage
+        with StageTimer(records, image_name_prefix, 'annotate') as timer:
+            timer.rows, timer.bytes_written = annotate_video(sdd_annotation_file, image_name_prefix,
+                                                             frame_numbers[-1], stale_formats,
+                                                             frame_numbers=frame_numbers, sink_options=sink_options,
+                                                             size=extract_outputs['size'],
+                                                             scale=extract_outputs['scale'])
+            timer.frames = len(frame_numbers)
+        for annotation_format in stale_formats:
+            record_stage(image_name_prefix, manifest, annotation_format, annotation_inputs[annotation_format], True,
+                         {'frames': len(frame_numbers)})
+        log('Annotation Complete.', 'success')
+    else:
+        log(video_file + ' is already annotated. Skipping...')
+
+    # Tile
+    if tiling_options is not None:
+        tiling_inputs = {'annotation': annotation_fingerprint, 'extract': extract_inputs, 'options': tiling_options}
+        if not stage_complete(manifest, 'tiles', tiling_inputs):
+            log('Tiling frames from ' + video_file)
+            remove_files(os.path.join(destination_path, 'tiles', 'images'), image_name_prefix)
+            remove_files(os.path.join(destination_path, 'tiles', 'labels'), image_name_prefix)
+            record_stage(image_name_prefix, manifest, 'tiles', tiling_inputs, False)
+            with StageTimer(records, image_name_prefix, 'tiles') as timer:
+                frame_index = build_frame_index(scale_annotation(
+                    load_annotation(sdd_annotation_file, image_name_prefix), extract_outputs['scale']))
+                frame_numbers = extracted_frame_numbers(extract_outputs['images'], frame_stride)
+                number_of_tiles, timer.bytes_written = tile_video(image_name_prefix, frame_index, frame_numbers,
+                                                                  extract_outputs['size'],
+                                                                  extract_outputs['image_ext'], **tiling_options)
+                timer.frames = len(frame_numbers)
+            record_stage(image_name_prefix, manifest, 'tiles', tiling_inputs, True, {'tiles': number_of_tiles})
+            log('Tiling Complete.', 'success')
+        else:
+            log(video_file + ' is already tiled. Skipping...')
+    return records
+
+
+def init_worker(worker_dataset_path, worker_destination_folder_name, worker_destination_path, worker_log_queue=None):
+    # The settings are module globals set in __main__, hand them over to the pool workers.
+    global dataset_path, destination_folder_name, destination_path, log_queue
+    dataset_path = worker_dataset_path
+    destination_folder_name = worker_destination_folder_name
+    destination_path = worker_destination_path
+    log_queue = worker_log_queue
+
+
+def prepare_video_worker(args):
+    scene, video_index, annotation_formats, frame_stride, sink_options, extraction_options, tiling_options = args
+    records = prepare_video(scene, video_index, annotation_formats, frame_stride, sink_options, extraction_options,
+                            tiling_options)
+    # The stage records go back to the main process for the run report
+    return scene, video_index, records
+
+
+def write_dataset_coco(videos_list, frame_strides, indent=None):
+    # One COCO file over all processed videos, with image and annotation IDs unique across
+    # the dataset. Built from the cached annotation arrays, not from the per-video json files.
+    writer = CocoWriter(os.path.join(destination_path, 'Annotations_json', destination_folder_name + '.json'),
+                        indent)
+    for scene, video_index in videos_list:
+        image_name_prefix = video_prefix(scene, video_index)
+        sdd_annotation_file = annotation_file(scene, video_index)
+        extract_outputs = load_manifest(image_name_prefix)['extract']['outputs']
+        frame_index = build_frame_index(scale_annotation(load_annotation(sdd_annotation_file, image_name_prefix),
+                                                         extract_outputs['scale']))
+        height, width, depth = extract_outputs['size']
+
+        for frame_number in extracted_frame_numbers(extract_outputs['images'], frame_strides[(scene, video_index)]):
+            image_id = writer.number_of_images + 1
+            writer.add_image(coco_image(image_id, image_name_prefix + str(frame_number) + extract_outputs['image_ext'],
+                                        width, height, depth))
+            for annotation_data in frame_annotations(frame_index, frame_number):
+                writer.add_annotation(coco_annotation(writer.number_of_annotations + 1, image_id, annotation_data))
+    writer.close()
+    return writer.number_of_images, writer.number_of_annotations, writer.bytes_written
+
+
+# Index of the samples of a split: which shard a sample is in, where, and how many bytes
+# of image and of annotation (json) it has.
+SHARD_INDEX_DTYPE = np.dtype([('name', 'S64'),
+                              ('shard', np.int32),
+                              ('offset', np.int64),
+                              ('image_size', np.int64),
+                              ('annotation_size', np.int64)])
+
+
+def write_shards(split_lists, videos_list, shard_size=1 << 30):
+    # Pack the images of each split, with their YOLO and COCO annotations, into large sequential
+    # shards/<split>-<n>.bin files, so data loaders read a few big files instead of
+    # many small ones. shards/<split>.idx.npy indexes the samples, see ShardReader.
+    # Returns the number of bytes written.
+    shards_path = os.path.join(destination_path, 'shards')
+    if not os.path.exists(shards_path):
+        os.makedirs(shards_path)
+    videos = dict((video_prefix(scene, video_index), (scene, video_index)) for scene, video_index in videos_list)
+    bytes_written = 0
+
+    for split in ('train', 'val', 'test'):
+        remove_files(shards_path, split + '-')
+        index = np.zeros(len(split_lists[split]), dtype=SHARD_INDEX_DTYPE)
+        shard_number = -1
+        shard = None
+        image_name_prefix = None
+        for sample, image_name in enumerate(split_lists[split]):
+            # The lists hold the frames of a video one after the other, load each video once.
+            if image_name[:image_name.rindex('_') + 1] != image_name_prefix:
+                image_name_prefix = image_name[:image_name.rindex('_') + 1]
+                sdd_annotation_file = annotation_file(*videos[image_name_prefix])
+                extract_outputs = load_manifest(image_name_prefix)['extract']['outputs']
+                frame_index = build_frame_index(scale_annotation(
+                    load_annotation(sdd_annotation_file, image_name_prefix), extract_outputs['scale']))
+                height, width, depth = extract_outputs['size']
+                yolo = YoloSink(None, image_name_prefix, width, height, depth)
+                yolo.start(frame_index)
+
+            if shard is None or shard.tell() >= shard_size:
+                if shard is not None:
+                    bytes_written += shard.tell()
+                    shard.close()
+                shard_number += 1
+                shard = open(os.path.join(shards_path, '{}-{:05d}.bin'.format(split, shard_number)), 'wb')
+
+            frame_number = int(image_name[len(image_name_prefix):])
+            assert len(image_name.encode('utf-8')) <= SHARD_INDEX_DTYPE['name'].itemsize, \
+                'Image name too long for the shard index: ' + image_name
+            with open(os.path.join(destination_path, 'images', image_name + extract_outputs['image_ext']), 'rb') as fid:
+                image = fid.read()
+            annotation = {'file_name': image_name + extract_outputs['image_ext'],
+                          'width': width, 'height': height, 'depth': depth,
+                          'yolo': yolo.frame_lines(frame_number),
+                          'coco': [coco_annotation(count, sample, annotation_data) for count, annotation_data in
+                                   enumerate(frame_annotations(frame_index, frame_number), 1)]}
+            annotation = json.dumps(annotation, separators=(',', ':')).encode('utf-8')
+
+            index[sample] = (image_name.encode('utf-8'), shard_number, shard.tell(), len(image), len(annotation))
+            shard.write(image)
+            shard.write(annotation)
+        if shard is not None:
+            bytes_written += shard.tell()
+            shard.close()
+
+        with open(os.path.join(shards_path, split + '.idx.npy.tmp'), 'wb') as fid:
+            np.save(fid, index)
+            bytes_written += fid.tell()
+        os.rename(os.path.join(shards_path, split + '.idx.npy.tmp'), os.path.join(shards_path, split + '.idx.npy'))
+    return bytes_written
+
+
+class ShardReader(object):
+    # Random access to the samples of a split written by write_shards. The index and the shards
+    # are memory-mapped, reader[i] returns (image bytes, annotation dict) of sample i.
+
+    def __init__(self, shards_path, split):
+        self.shards_path = shards_path
+        self.split = split
+        self.index = np.load(os.path.join(shards_path, split + '.idx.npy'), mmap_mode='r')
+        self.shards = dict()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard_number):
+        if shard_number not in self.shards:
+            with open(os.path.join(self.shards_path, '{}-{:05d}.bin'.format(self.split, shard_number)), 'rb') as fid:
+                self.shards[shard_number] = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shards[shard_number]
+
+    def __getitem__(self, sample):
+        entry = self.index[sample]
+        shard = self._shard(int(entry['shard']))
+        offset = int(entry['offset'])
+        image_end = offset + int(entry['image_size'])
+        image = shard[offset:image_end]
+        annotation = json.loads(shard[image_end:image_end + int(entry['annotation_size'])].decode('utf-8'))
+        return image, annotation
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = dict()
 
-                # Split video into frames
-                # Check whether the video has already been made into frames
-                jpeg_image_path = os.path.join(destination_path, 'images')
-                image_name_prefix = scene + '_video' + str(video_index) + '_'
-                video_file = os.path.join(video_path, 'video.mov')
-                if count_files(jpeg_image_path, image_name_prefix) == 0:
-                    # Split Video
-                    log('Splitting ' + video_file)
-                    split_video(video_file, image_name_prefix)
-                    log('Splitting ' + video_file + ' complete.')
-
-                    # Annotate
-                    log('Annotating frames from ' + video_file)
-                    sdd_annotation_file = os.path.join(dataset_path, 'annotations', scene,
-                                                       'video' + str(video_index), 'annotations.txt')
-                    assert_path(sdd_annotation_file, 'Annotation file not found. '
-                                                     'Trying to access ' + sdd_annotation_file)
-                    dest_path = os.path.join(destination_path, 'Annotations')
-                    number_of_frames = count_files(jpeg_image_path, image_name_prefix)
-                    # Create xml, json and txt annotations
-                    annotate_frames(sdd_annotation_file, dest_path, image_name_prefix, number_of_frames)
-                    dest_path_json = os.path.join(destination_path, 'Annotations_json')
-                    annotate_frames_json(sdd_annotation_file, dest_path_json, image_name_prefix, number_of_frames)
-                    dest_path = os.path.join(destination_path, 'labels')
-                    annotate_frames_txt(sdd_annotation_file, dest_path, image_name_prefix, number_of_frames)
-
-                    log('Annotation Complete.')
-
-                else:
-                    log(video_file + ' is already split into frames. Skipping...')
-
-                # Create train-val-test split
-                number_of_frames = count_files(jpeg_image_path, image_name_prefix)
-                split_ratio = videos.get(video_index)
-                if num_training_images is not None and num_val_images is not None and num_testing_images is not None:
-                    split_dataset_uniformly(number_of_frames, split_ratio, share, image_name_prefix)
-                else:
-                    split_dataset(number_of_frames, split_ratio, image_name_prefix)
-                log('Successfully created train-val-test split.')
-    log('Done.')
+
+def split_and_annotate(num_training_images=None, num_val_images=None, num_testing_images=None,
+                       json_annot=False, txt_annot=False, annotation_formats=DEFAULT_ANNOTATION_FORMATS,
+                       workers=1, extract_selected_only=False, coco_indent=None, seed=None, voc_archive=None,
+                       extraction_options=None, shards=False, shard_size=1 << 30, tiling_options=None):
+    assert_path(dataset_path, ''.join(e for e in dataset_path if e.isalnum()) + ' folder should be found in the cwd of this script.')
+    init_directories()
+    uniform_split = num_training_images is not None and num_val_images is not None and num_testing_images is not None
+    if uniform_split:
+        share = calculate_share(num_training_images, num_val_images, num_testing_images)
+    assert uniform_split or not extract_selected_only, 'Extracting only the selected frames needs a uniform split.'
+    videos_list = list_videos()
+    report = {'started': time.time(), 'workers': workers, 'videos': ['{}_video{}'.format(scene, video_index)
+                                                                     for scene, video_index in videos_list]}
+    records = []
+
+    # Work out which frames the uniform split picks before splitting the videos, so that
+    # only those frames get decoded, written and annotated.
+    frame_strides = dict()
+    sink_options = {'xml': {'archive': voc_archive}, 'json': {'indent': coco_indent}}
+    jobs = []
+    for scene, video_index in videos_list:
+        frame_stride = 1
+        if extract_selected_only:
+            image_name_prefix = video_prefix(scene, video_index)
+            frame_count = load_video_metadata(video_file_path(scene, video_index), image_name_prefix)['frame_count']
+            if frame_count <= 0:
+                # Not every container records the frame count, the annotation spans the whole video.
+                frame_count = int(load_annotation(annotation_file(scene, video_index),
+                                                  image_name_prefix)['frame'].max()) + 1
+            split_ratio = videos_to_be_processed.get(scene).get(video_index)
+            frame_stride = uniform_frame_stride(frame_count, split_ratio, share)
+        frame_strides[(scene, video_index)] = frame_stride
+        jobs.append((scene, video_index, annotation_formats, frame_stride, sink_options, extraction_options,
+                     tiling_options))
+
+    # Frame extraction and annotation of different videos are independent, run them on a pool of workers.
+    progress = Progress(len(jobs))
+    if workers > 1:
+        # The workers send their messages here, a thread prints them as whole lines.
+        worker_log_queue = multiprocessing.Queue()
+        log_relay = threading.Thread(target=relay_logs, args=(worker_log_queue,))
+        log_relay.start()
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                    initargs=(dataset_path, destination_folder_name, destination_path,
+                                              worker_log_queue))
+        try:
+            for scene, video_index, video_records in pool.imap_unordered(prepare_video_worker, jobs):
+                records.extend(video_records)
+                progress.update('{} video{} ready.'.format(scene, video_index))
+            pool.close()
+        except BaseException:
+            # Do not wait for the remaining videos before reporting the error.
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            worker_log_queue.put(None)
+            log_relay.join()
+    else:
+        for job in jobs:
+            scene, video_index, video_records = prepare_video_worker(job)
+            records.extend(video_records)
+            progress.update('{} video{} ready.'.format(scene, video_index))
+
+    if 'json' in annotation_formats:
+        # Rewrite the dataset wide file only when one of the per-video json files changed.
+        coco_inputs = {'videos': [load_manifest(video_prefix(scene, video_index))['json']['inputs']
+                                  for scene, video_index in videos_list],
+                       'indent': coco_indent}
+        manifest = load_manifest(destination_folder_name)
+        if not stage_complete(manifest, 'json', coco_inputs):
+            log('Writing dataset wide COCO annotation.')
+            record_stage(destination_folder_name, manifest, 'json', coco_inputs, False)
+            with StageTimer(records, destination_folder_name, 'dataset_json') as timer:
+                timer.frames, timer.rows, timer.bytes_written = write_dataset_coco(videos_list, frame_strides,
+                                                                                   coco_indent)
+            record_stage(destination_folder_name, manifest, 'json', coco_inputs, True)
+
+    # Create train-val-test split, always in videos_to_be_processed order so that the
+    # list files do not depend on the order the workers finished in.
+    split_lists = new_split_lists()
+    random_state = np.random.RandomState(seed)
+    split_records = []
+    for scene, video_index in videos_list:
+        image_name_prefix = video_prefix(scene, video_index)
+        number_of_frames = load_manifest(image_name_prefix)['extract']['outputs']['images']
+        split_ratio = videos_to_be_processed.get(scene).get(video_index)
+        split_inputs = {'number_of_frames': number_of_frames, 'split_ratio': split_ratio}
+        if uniform_split:
+            split_inputs['share'] = share
+            frame_numbers = None
+            if extract_selected_only:
+                # Only the frames that were extracted, the frame count of the container can be off.
+                split_inputs['frame_stride'] = frame_strides[(scene, video_index)]
+                frame_numbers = extracted_frame_numbers(number_of_frames, frame_strides[(scene, video_index)])
+            split_dataset_uniformly(number_of_frames, split_ratio, share, image_name_prefix, split_lists,
+                                    frame_numbers)
+        else:
+            split_inputs['seed'] = seed
+            split_dataset(number_of_frames, split_ratio, image_name_prefix, split_lists, random_state)
+        split_records.append((image_name_prefix, split_inputs))
+    with StageTimer(records, destination_folder_name, 'split') as timer:
+        timer.bytes_written = write_split_lists(split_lists)
+        timer.rows = sum(len(split_lists[name]) for name in SPLIT_LISTS)
+    if shards:
+        # The shards follow the split and the frames and annotation of the videos, rewrite
+        # them only when one of those changed.
+        shard_inputs = {'splits': dict(), 'videos': [], 'shard_size': shard_size}
+        for split in ('train', 'val', 'test'):
+            shard_inputs['splits'][split] = hashlib.sha1('\n'.join(split_lists[split]).encode('utf-8')).hexdigest()
+        for scene, video_index in videos_list:
+            extract_inputs = load_manifest(video_prefix(scene, video_index))['extract']['inputs']
+            shard_inputs['videos'].append({'extract': extract_inputs,
+                                           'annotation': file_fingerprint(annotation_file(scene, video_index))})
+        manifest = load_manifest(destination_folder_name)
+        if not stage_complete(manifest, 'shards', shard_inputs):
+            log('Writing shards.')
+            record_stage(destination_folder_name, manifest, 'shards', shard_inputs, False)
+            with StageTimer(records, destination_folder_name, 'shards') as timer:
+                timer.bytes_written = write_shards(split_lists, videos_list, shard_size)
+                timer.frames = sum(len(split_lists[split]) for split in ('train', 'val', 'test'))
+            record_stage(destination_folder_name, manifest, 'shards', shard_inputs, True)
+        else:
+            log('Shards are up to date. Skipping...')
+    # The lists are cheap to rebuild and always are, the manifest just records what went into them.
+    for image_name_prefix, split_inputs in split_records:
+        record_stage(image_name_prefix, load_manifest(image_name_prefix), 'split', split_inputs, True)
+    log('Successfully created train-val-test split.', 'success')
+
+    report['wall_time'] = time.time() - report['started']
+    report['stages'] = records
+    report['totals'] = summarize_stages(records)
+    log('Run report written to ' + write_run_report(report))
+    log('Done in ' + format_duration(report['wall_time']) + '.', 'success')
 
 
 if __name__ == '__main__':
@@ -430,5 +1685,20 @@ if __name__ == '__main__':
     destination_folder_name = 'sdd'
     destination_path = os.path.join(dataset_path, destination_folder_name)
 
+    # How frames are extracted, see split_video. eg: {'backend': 'cv2', 'quality': 90, 'scale': 0.5, 'threads': 8}
+    # decodes with OpenCV and writes half size JPEGs from 8 encoder threads, boxes are scaled to match.
+    extraction_options = None
+
+    # Seed of the random train-val-test split, None for a different split on every run
+    seed = None
+
+    # Number of videos to split and annotate in parallel
+    workers = 1
+
+    # Only decode and annotate the frames the uniform split selects
+    extract_selected_only = False
+
     # split_and_annotate()
-    split_and_annotate(num_training_images, num_val_images, num_testing_images)
+    split_and_annotate(num_training_images, num_val_images, num_testing_images, workers=workers,
+                       extract_selected_only=extract_selected_only, seed=seed,
+                       extraction_options=extraction_options)
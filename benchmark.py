@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import subprocess
+import numpy as np
+import cv2
+
+import annotate
+
+
+# Synthetic videos: name -> (number of frames, number of tracks, width, height)
+SCALES = {'small': (300, 40, 640, 480),
+          'medium': (1500, 150, 1280, 720),
+          'large': (6000, 400, 1920, 1080)}
+
+# Label mix of the synthetic tracks, roughly that of SDD.
+LABEL_WEIGHTS = {'Pedestrian': 0.6, 'Biker': 0.25, 'Skater': 0.05, 'Cart': 0.04, 'Car': 0.04, 'Bus': 0.02}
+
+
+def generate_annotation(annotation_file, number_of_frames, number_of_tracks, width, height, random_state):
+    # Tracks with a random start, length and random walk, in the annotations.txt format of SDD.
+    labels = list(LABEL_WEIGHTS.keys())
+    weights = np.array(list(LABEL_WEIGHTS.values()))
+    lines = []
+    for track_id in range(number_of_tracks):
+        label = labels[random_state.choice(len(labels), p=weights / weights.sum())]
+        length = random_state.randint(number_of_frames // 10, number_of_frames + 1)
+        start = random_state.randint(0, number_of_frames - length + 1)
+        box_width, box_height = random_state.randint(10, 60, size=2)
+        steps = random_state.randint(-3, 4, size=(length, 2))
+        position = np.cumsum(steps, axis=0) + random_state.randint(0, [width, height])
+        position = np.clip(position, -box_width // 2, [width - box_width // 2, height - box_height // 2])
+        flags = random_state.random_sample((length, 3)) < (0.05, 0.2, 0.3)
+        for frame, ((x, y), (lost, occluded, generated)) in enumerate(zip(position.tolist(), flags.tolist()), start):
+            lines.append('%d %d %d %d %d %d %d %d %d "%s"\n' % (track_id, x, y, x + box_width, y + box_height, frame,
+                                                                 lost, occluded, generated, label))
+    with open(annotation_file, 'w') as fout:
+        fout.write(''.join(lines))
+    return len(lines)
+
+
+def generate_video(video_file, number_of_frames, width, height):
+    writer = cv2.VideoWriter(video_file, cv2.VideoWriter_fourcc(*'mp4v'), 30, (width, height))
+    assert writer.isOpened(), 'Cannot write ' + video_file
+    background = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    for frame_number in range(number_of_frames):
+        frame = np.roll(background, frame_number * 4, axis=1)
+        writer.write(cv2.merge((frame, frame[::-1], np.full_like(frame, frame_number % 256))))
+    writer.release()
+
+
+def generate_dataset(root, scale, random_state):
+    # One scene with one video in the StanfordDroneDataset layout:
+    # videos/<scene>/video0/video.mov and annotations/<scene>/video0/annotations.txt
+    number_of_frames, number_of_tracks, width, height = SCALES[scale]
+    video_path = os.path.join(root, 'videos', scale, 'video0')
+    annotation_path = os.path.join(root, 'annotations', scale, 'video0')
+    os.makedirs(video_path)
+    os.makedirs(annotation_path)
+    generate_video(os.path.join(video_path, 'video.mov'), number_of_frames, width, height)
+    return generate_annotation(os.path.join(annotation_path, 'annotations.txt'), number_of_frames, number_of_tracks,
+                               width, height, random_state)
+
+
+def run_stage(function, args, kwargs):
+    # Runs in a fresh process, so that its peak RSS is that of this stage alone (plus the
+    # interpreter and imports, see the 'baseline' stage, and the ffmpeg child if any).
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start, annotate.process_peak_rss()
+
+
+def time_stage(results, scale, stage, frames, rows, function, *args, **kwargs):
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(1, initializer=annotate.init_worker,
+                        initargs=(annotate.dataset_path, annotate.destination_folder_name, annotate.destination_path))
+    try:
+        seconds, peak_rss = pool.apply(run_stage, (function, args, kwargs))
+    finally:
+        pool.close()
+        pool.join()
+    result = {'scale': scale,
+              'stage': stage,
+              'seconds': seconds,
+              'frames': frames,
+              'rows': rows,
+              'frames_per_sec': frames / seconds if frames else None,
+              'rows_per_sec': rows / seconds if rows else None,
+              'peak_rss_mb': peak_rss / (1024. * 1024.) if peak_rss is not None else None}
+    results.append(result)
+    annotate.log('{:>8} {:<16} {:8.3f}s {:>12} frames/s {:>12} rows/s {:>8} MB'.format(
+        scale, stage, seconds,
+        '-' if result['frames_per_sec'] is None else '{:.0f}'.format(result['frames_per_sec']),
+        '-' if result['rows_per_sec'] is None else '{:.0f}'.format(result['rows_per_sec']),
+        '-' if result['peak_rss_mb'] is None else '{:.1f}'.format(result['peak_rss_mb'])))
+
+
+def baseline():
+    pass
+
+
+def write_split(number_of_frames, image_name_prefix, seed):
+    split_lists = annotate.new_split_lists()
+    annotate.split_dataset(number_of_frames, (.5, .2, .3), image_name_prefix, split_lists,
+                           np.random.RandomState(seed))
+    annotate.write_split_lists(split_lists)
+
+
+def benchmark_scale(root, scale, backend, seed):
+    results = []
+    random_state = np.random.RandomState(seed)
+    dataset_root = os.path.join(root, scale)
+    # Start from a clean folder when the work folder is reused
+    if os.path.exists(dataset_root):
+        shutil.rmtree(dataset_root)
+    number_of_rows = generate_dataset(dataset_root, scale, random_state)
+
+    annotate.dataset_path = dataset_root
+    annotate.destination_folder_name = 'sdd'
+    annotate.destination_path = os.path.join(dataset_root, 'sdd')
+    annotate.init_directories()
+
+    video_file = os.path.join(dataset_root, 'videos', scale, 'video0', 'video.mov')
+    sdd_annotation_file = os.path.join(dataset_root, 'annotations', scale, 'video0', 'annotations.txt')
+    image_name_prefix = scale + '_video0_'
+    images_path = os.path.join(annotate.destination_path, 'images')
+
+    # Memory of the interpreter and the imports, part of the peak RSS of every stage
+    time_stage(results, scale, 'baseline', None, None, baseline)
+    time_stage(results, scale, 'extract', SCALES[scale][0], None,
+               annotate.split_video, video_file, image_name_prefix, backend=backend)
+    number_of_frames = annotate.count_images(images_path, image_name_prefix)
+
+    time_stage(results, scale, 'annotation_parse', None, number_of_rows,
+               annotate.parse_sdd_annotation, sdd_annotation_file)
+    time_stage(results, scale, 'annotation_cold', None, number_of_rows,
+               annotate.load_annotation, sdd_annotation_file, image_name_prefix)
+    time_stage(results, scale, 'annotation_warm', None, number_of_rows,
+               annotate.load_annotation, sdd_annotation_file, image_name_prefix)
+
+    # Each export loads the cached annotation and builds the frame index itself, as in the pipeline
+    size = annotate.image_size(os.path.join(images_path, image_name_prefix + '1.jpg'))
+    for annotation_format in ('xml', 'json', 'txt'):
+        time_stage(results, scale, 'export_' + annotation_format, number_of_frames, number_of_rows,
+                   annotate.annotate_video, sdd_annotation_file, image_name_prefix, number_of_frames,
+                   (annotation_format,), size=size)
+    time_stage(results, scale, 'export_all', number_of_frames, number_of_rows,
+               annotate.annotate_video, sdd_annotation_file, image_name_prefix, number_of_frames,
+               annotate.DEFAULT_ANNOTATION_FORMATS, size=size)
+    time_stage(results, scale, 'split', number_of_frames, None, write_split, number_of_frames, image_name_prefix, seed)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times each stage of split_and_annotate on synthetic SDD data.')
+    parser.add_argument('--scales', default='small,medium', help='Comma separated, from: ' + ', '.join(SCALES))
+    parser.add_argument('--backend', default='ffmpeg', choices=('ffmpeg', 'cv2'), help='Frame extraction backend.')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='Keep the synthetic data in this folder.')
+    args = parser.parse_args()
+
+    scales = args.scales.split(',')
+    for scale in scales:
+        assert scale in SCALES, 'Unknown scale ' + scale
+
+    root = args.workdir if args.workdir is not None else tempfile.mkdtemp(prefix='sdd_benchmark_')
+    try:
+        results = []
+        for scale in scales:
+            results.extend(benchmark_scale(root, scale, args.backend, args.seed))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(root)
+
+    report = {'revision': git_revision(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'opencv': cv2.__version__,
+              'backend': args.backend,
+              'results': results}
+    with open(args.output, 'w') as fout:
+        json.dump(report, fout, indent=4)
+    annotate.log('Results written to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()